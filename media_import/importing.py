@@ -1,24 +1,32 @@
-from concurrent.futures import Future
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from typing import (
     Callable,
+    Deque,
     Dict,
     List,
     NamedTuple,
+    Optional,
     Sequence,
-    NamedTuple,
+    Set,
     Tuple,
 )
 from requests.exceptions import RequestException
-from datetime import datetime, timedelta
+from functools import partial
+from itertools import compress
+from pathlib import Path
 import unicodedata
+import math
+import os
+import time
 import traceback
 
 from anki.media import media_paths_from_col_path
 from aqt import mw
 from aqt.utils import askUserDialog
 
-from .pathlike import FileLike, RootPath, LocalRoot
-from .pathlike.errors import AddonError
+from .pathlike import FileLike, RootPath, LocalFile, LocalRoot
+from .pathlike.errors import AddonError, RateLimitError
 
 
 class ImportResult(NamedTuple):
@@ -29,22 +37,24 @@ class ImportResult(NamedTuple):
 class ImportInfo:
     """Handles files_list count and their size"""
 
-    files: list
+    SIZE_UNITS = ("Bytes", "KB", "MB", "GB", "TB")
+
+    files: Sequence[FileLike]
     tot: int
     prev: int
+    in_flight: int  # Files taken from `files` but not yet added
 
     tot_size: int
     size: int
-    prev_time: datetime
-    prev_file_size: int
+    start_time: float  # time.monotonic() when size was calculated
 
-    def __init__(self, files: list) -> None:
+    def __init__(self, files: Sequence[FileLike]) -> None:
         self.files = files
         self.tot = len(files)
         self.prev = self.tot
         self.diff = 0
+        self.in_flight = 0
         self.calculate_size()
-        self.tot_size = self.size
 
     def update_count(self) -> int:
         """Returns `prev - curr`, then updates prev to curr"""
@@ -53,24 +63,23 @@ class ImportInfo:
         return self.diff
 
     def calculate_size(self) -> None:
-        self.size = 0
-        for file in self.files:
-            self.size += file.size
-        self.prev_time = datetime.now()
-        self.prev_file_size = 0
+        self.size = sum(file.size for file in self.files)
+        self.tot_size = self.size
+        self.start_time = time.monotonic()
 
     def update_size(self, file: FileLike) -> None:
+        """Call when `file` was added."""
         self.size -= file.size
-        self.prev_file_size = file.size
-        self.prev_time = datetime.now()
 
     @property
     def remaining_time_str(self) -> str:
-        if not self.prev_file_size and self.prev_time:
+        # Estimated from the average rate since start, as files are added
+        # concurrently and finish at uneven intervals.
+        done_size = self.tot_size - self.size
+        if done_size <= 0:
             return ""
-        timedelta = datetime.now() - self.prev_time
-        estimate = timedelta * self.size / self.prev_file_size
-        return self._format_timedelta(estimate)
+        elapsed = time.monotonic() - self.start_time
+        return self._format_seconds(int(elapsed * self.size / done_size))
 
     @property
     def size_str(self) -> str:
@@ -82,14 +91,13 @@ class ImportInfo:
 
     @property
     def curr(self) -> int:
-        return len(self.files)
+        return len(self.files) + self.in_flight
 
     @property
     def left(self) -> int:
         return self.tot - self.curr
 
-    def _format_timedelta(self, timedelta: timedelta) -> str:
-        tot_secs = timedelta.seconds
+    def _format_seconds(self, tot_secs: int) -> str:
         units = [60, 60 * 60, 60 * 60 * 24]
         seconds = tot_secs % units[0]
         minutes = (tot_secs % units[1]) // units[0]
@@ -108,11 +116,8 @@ class ImportInfo:
 
     def _size_str(self, size: float) -> str:
         """Prints size of imported files."""
-        for unit in ["Bytes", "KB", "MB", "GB"]:
-            if size < 1000:
-                return "%3.1f%s" % (size, unit)
-            size = size / 1000
-        return "%.1f%s" % (size, "TB")
+        idx = min(int(math.log10(max(size, 1)) // 3), len(self.SIZE_UNITS) - 1)
+        return "%3.1f%s" % (size / 1000**idx, self.SIZE_UNITS[idx])
 
 
 def import_media(src: RootPath, on_done: Callable[[ImportResult], None]) -> None:
@@ -129,13 +134,20 @@ def import_media(src: RootPath, on_done: Callable[[ImportResult], None]) -> None
     try:
         _import_media(logs, src, finish_import)
     except Exception as err:
-        tb = traceback.format_exc()
-        print(tb)
-        print(str(err))
-        logs.append(tb)
-        logs.append(str(err))
-        res = ImportResult(logs, success=False)
-        finish_import(res)
+        fail_import(logs, err, finish_import)
+
+
+def fail_import(
+    logs: List[str], err: Exception, on_done: Callable[[ImportResult], None]
+) -> None:
+    """Logs the exception being handled and reports a failed import."""
+    tb = traceback.format_exc()
+    print(tb)
+    print(str(err))
+    logs.append(tb)
+    logs.append(str(err))
+    res = ImportResult(logs, success=False)
+    on_done(res)
 
 
 def _import_media(
@@ -150,182 +162,325 @@ def _import_media(
         result = ImportResult(logs, success)
         on_done(result)
 
-    # 1. Get the name of all media files.
-    files_list = src.files
-    info = ImportInfo(files_list)
-    log(f"{info.tot} media files found.")
-
-    # 2. Normalize file names
-    unnormalized = find_unnormalized_name(files_list)
-    if len(unnormalized):
-        finish_import(
-            f"{len(unnormalized)} files have invalid file names: {unnormalized}",
-            success=False,
-        )
-        return
+    def check_files() -> Tuple[Optional[str], ImportInfo, List[FileLike]]:
+        """Returns (error msg if files can't be imported, info, conflicting files)"""
+        # 1. Get the name of all media files.
+        files_list = src.files
+        info = ImportInfo(files_list)
+        log(f"{info.tot} media files found.")
+
+        # 2. Normalize file names
+        if has_unnormalized_name(files_list):
+            unnormalized = list_unnormalized_name(files_list)
+            return (
+                f"{len(unnormalized)} files have invalid file names: {unnormalized}",
+                info,
+                [],
+            )
 
-    # 3. Make sure there isn't a name conflict within new files.
-    if name_conflict_exists(files_list):
-        finish_import("There are multiple files with same filename.", success=False)
-        return
+        if mw.progress.want_cancel():
+            return ("Import aborted.", info, [])
 
-    if info.update_count():
-        log(f"{info.diff} files were skipped because they are identical.")
+        # 3. Make sure there isn't a name conflict within new files.
+        if name_conflict_exists(files_list):
+            return ("There are multiple files with same filename.", info, [])
 
-    # 4. Check collection.media if there is a file with same name.
-    name_conflicts = name_exists_in_collection(files_list)
-    if len(name_conflicts):
-        msg = f"{len(name_conflicts)} files have the same name as existing media files:"
-        log(msg)
-        file_names_str = ""
-        for file in name_conflicts:
-            file_names_str += file.name + "\n"
-        log(file_names_str + "-" * 16)
-        ask_msg = msg + "\nDo you want to import the rest of the files?"
-        mw.progress.finish()  # Close progress window for askUserDialog
-        diag = askUserDialog(ask_msg, buttons=["Abort Import", "Continue Import"])
-        if diag.run() == "Abort Import":
-            # finish_import calls mw.progress.finish()
-            mw.progress.start(parent=mw)
-            finish_import(
-                "Aborted import due to name conflict with existing media", success=False
+        if info.update_count():
+            log(f"{info.diff} files were skipped because they are identical.")
+
+        if mw.progress.want_cancel():
+            return ("Import aborted.", info, [])
+
+        # 4. Check collection.media if there is a file with same name.
+        return (None, info, name_exists_in_collection(files_list))
+
+    def on_files_checked(future: Future) -> None:
+        try:
+            (error_msg, info, name_conflicts) = future.result()
+            if error_msg:
+                finish_import(error_msg, success=False)
+                return
+            if mw.progress.want_cancel():
+                finish_import("Import aborted.", success=False)
+                return
+            import_checked_files(info, name_conflicts)
+        except Exception as err:
+            fail_import(logs, err, on_done)
+
+    def import_checked_files(info: ImportInfo, name_conflicts: List[FileLike]) -> None:
+        if len(name_conflicts):
+            msg = f"{len(name_conflicts)} files have the same name as existing media files:"
+            log(msg)
+            log("\n".join(file.name for file in name_conflicts) + "\n" + "-" * 16)
+            ask_msg = msg + "\nDo you want to import the rest of the files?"
+            mw.progress.finish()  # Close progress window for askUserDialog
+            diag = askUserDialog(ask_msg, buttons=["Abort Import", "Continue Import"])
+            if diag.run() == "Abort Import":
+                # finish_import calls mw.progress.finish()
+                mw.progress.start(parent=mw)
+                finish_import(
+                    "Aborted import due to name conflict with existing media",
+                    success=False,
+                )
+                return
+            mw.progress.start(parent=mw, label="Importing media", immediate=True)
+        if info.update_count():
+            diff = info.diff - len(name_conflicts)
+            log(
+                f"{diff} files were skipped because they already exist in collection."
             )
-            return
-        mw.progress.start(parent=mw, label="Importing media", immediate=True)
-    if info.update_count():
-        diff = info.diff - len(name_conflicts)
-        log(f"{diff} files were skipped because they already exist in collection.")
 
-    # remove name conflicting files from total file count
-    info.tot = len(info.files)
+        # remove name conflicting files from total file count
+        info.tot = len(info.files)
 
-    if info.curr == 0:
-        finish_import(f"{info.tot} media files were imported", success=True)
-        return
+        if info.curr == 0:
+            finish_import(f"{info.tot} media files were imported", success=True)
+            return
 
-    # 5. Add media files in chunk in background.
-    log(f"{info.curr} media files will be processed.")
-    info.calculate_size()
+        # 5. Add media files in chunk in background.
+        log(f"{info.curr} media files will be processed.")
+        # Files are consumed from the front and retried at the back.
+        files_queue = deque(info.files)
+        info.files = files_queue
+        info.calculate_size()
 
-    def import_files_list(
-        files_list: List[FileLike] = files_list, info: ImportInfo = info
-    ) -> Tuple[bool, str]:
-        """returns (is_success, result msg)"""
-        MAX_ERRORS = 5
-        error_cnt = 0  # Count of errors in succession
+        def on_import_done(future: Future) -> None:
+            try:
+                (success, msg) = future.result()
+                finish_import(msg, success)
+            except Exception as err:
+                raise err
+
+        mw.taskman.run_in_background(
+            task=import_files_list,
+            on_done=on_import_done,
+            args={"files_list": files_queue, "info": info, "log": log},
+        )
 
+    # Sizing and checking files may stat or hash every file, so keep it off
+    # the main thread.
+    mw.taskman.run_in_background(task=check_files, on_done=on_files_checked)
+
+
+def import_files_list(
+    files_list: Deque[FileLike], info: ImportInfo, log: Callable[[str], None]
+) -> Tuple[bool, str]:
+    """Adds files in background. returns (is_success, result msg)"""
+    MAX_ERRORS = 5
+    MAX_WORKERS = 8  # Files being downloaded concurrently
+    # Downloaded files are held in memory until written. Caps their total size,
+    # though a single larger file is still downloaded on its own.
+    MAX_PENDING_SIZE = 100 * 1000 * 1000
+    PROGRESS_INTERVAL = 0.05  # Minimum seconds between progress updates
+    RATE_LIMIT_DELAY = 2.0  # Seconds to wait after the first rate limit error
+    error_cnt = 0  # Count of errors in succession
+    submit_cnt = 0  # Count of downloads started
+    error_submit_cnt = 0  # submit_cnt when error_cnt was last increased
+    rate_limit_cnt = 0  # Count of rate limit backoffs in succession
+    resume_time = 0.0  # Don't start downloads before this time.monotonic()
+    last_update = 0.0
+    progress_template = (
+        f"Adding media files ({{}} / {info.tot})\n"
+        f"{{}}/{info.tot_size_str} ({{}} left)"
+    )
+    # Files are downloaded in worker threads while this thread writes
+    # the downloaded ones to the collection.
+    pending: Dict[Future, Tuple[FileLike, int]] = {}  # {future: (file, submit_cnt)}
+    pending_size = 0  # Sum of file sizes in pending
+    # Bound once as they are used for every file
+    write_data = mw.col.media.write_data
+    want_cancel = mw.progress.want_cancel
+    run_on_main = mw.taskman.run_on_main
+    update_progress = mw.progress.update
+
+    def give_up() -> Tuple[bool, str]:
+        log(f"{info.left} files were not imported.")
+        if info.left < 10:
+            for file in files_list:
+                log(file.name)
+        return (False, f"{info.left} / {info.tot} media files were imported.")
+
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
         while True:
+            while (
+                len(files_list)
+                and len(pending) < MAX_WORKERS
+                and (
+                    len(pending) == 0
+                    or pending_size + files_list[0].size <= MAX_PENDING_SIZE
+                )
+                and time.monotonic() >= resume_time
+            ):
+                file = files_list.popleft()
+                pending_size += file.size
+                submit_cnt += 1
+                pending[executor.submit(file.read_bytes)] = (file, submit_cnt)
+            info.in_flight = len(pending)
+
             # Last file was added
-            if len(files_list) == 0:
+            if len(pending) == 0 and len(files_list) == 0:
                 return (True, f"{info.tot} media files were imported.")
 
             # Abort import
-            if mw.progress.want_cancel():
+            if want_cancel():
                 return (
                     False,
                     f"Import aborted.\n{info.left} / {info.tot} media files were imported.",
                 )
 
-            progress_msg = (
-                f"Adding media files ({info.left} / {info.tot})\n"
-                f"{info.size_str}/{info.tot_size_str} "
-                f"({info.remaining_time_str} left)"
-            )
-            mw.taskman.run_on_main(
-                lambda: mw.progress.update(
-                    label=progress_msg, value=info.left, max=info.tot
+            # Throttle progress updates as each one wakes the main thread
+            now = time.monotonic()
+            if now - last_update >= PROGRESS_INTERVAL:
+                last_update = now
+                progress_msg = progress_template.format(
+                    info.left, info.size_str, info.remaining_time_str
+                )
+                run_on_main(
+                    partial(
+                        update_progress,
+                        label=progress_msg,
+                        value=info.left,
+                        max=info.tot,
+                    )
                 )
+
+            # Time out to check want_cancel() while downloads are running
+            if len(pending) == 0:  # Backing off from rate limit
+                time.sleep(PROGRESS_INTERVAL)
+                continue
+            (done, _) = wait(
+                pending, timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED
             )
+            for future in done:
+                (file, submitted_at) = pending.pop(future)
+                pending_size -= file.size
+                info.in_flight = len(pending)
+                try:
+                    add_media(file, future.result(), write_data)
+                    info.update_size(file)
+                    error_cnt = 0  # reset error_cnt on success
+                    rate_limit_cnt = 0
+                except RateLimitError as err:
+                    files_list.append(file)
+                    # Downloads in flight hit the same limit; back off once for them.
+                    if time.monotonic() < resume_time:
+                        continue
+                    rate_limit_cnt += 1
+                    if rate_limit_cnt > MAX_ERRORS:
+                        log(str(err))
+                        return give_up()
+                    delay = RATE_LIMIT_DELAY * 2 ** (rate_limit_cnt - 1)
+                    log(f"{err}\nRetrying in {delay:.0f}s.")
+                    resume_time = time.monotonic() + delay
+                except (AddonError, RequestException) as err:
+                    log("-" * 16 + "\n" + str(err) + "\n" + "-" * 16)
+                    # Downloads that were in flight together likely failed for
+                    # the same reason, e.g. a network drop. Count them once.
+                    if submitted_at > error_submit_cnt:
+                        error_cnt += 1
+                        error_submit_cnt = submit_cnt
+                    files_list.append(file)
+                    if error_cnt > MAX_ERRORS:
+                        return give_up()
+    finally:
+        # Don't block on running downloads when aborting.
+        # (cancel_futures needs Python 3.9, Anki 2.1.49 ships 3.8)
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
 
-            file = files_list.pop(0)
-            info.update_size(file)
 
-            try:
-                add_media(file)
-                error_cnt = 0  # reset error_cnt on success
-            except (AddonError, RequestException) as err:
-                error_cnt += 1
-                log("-" * 16 + "\n" + str(err) + "\n" + "-" * 16)
-                if error_cnt > MAX_ERRORS:
-                    log(f"{info.left} files were not imported.")
-                    if info.left < 10:
-                        for file in files_list:
-                            log(file.name)
-                    return (
-                        False,
-                        f"{info.left} / {info.tot} media files were imported.",
-                    )
-                else:
-                    files_list.append(file)
+def is_unnormalized_name(name: str) -> bool:
+    # ASCII names are always NFC normalized.
+    return not name.isascii() and name != unicodedata.normalize("NFC", name)
 
-    def on_import_done(future: Future) -> None:
-        try:
-            (success, msg) = future.result()
-            finish_import(msg, success)
-        except Exception as err:
-            raise err
 
-    mw.taskman.run_in_background(task=import_files_list, on_done=on_import_done)
+def has_unnormalized_name(files: Sequence[FileLike]) -> bool:
+    """Returns True if any file name is not normalized."""
+    return any(is_unnormalized_name(file.name) for file in files)
 
 
-def find_unnormalized_name(files: Sequence[FileLike]) -> List[FileLike]:
+def list_unnormalized_name(files: Sequence[FileLike]) -> List[FileLike]:
     """Returns list of files whose names are not normalized."""
-    unnormalized = []
-    for file in files:
-        name = file.name
-        normalized_name = unicodedata.normalize("NFC", name)
-        if name != normalized_name:
-            unnormalized.append(file)
-    return unnormalized
+    return [file for file in files if is_unnormalized_name(file.name)]
 
 
 def name_conflict_exists(files_list: List[FileLike]) -> bool:
     """Returns True if there are different files with the same name.
     And removes identical files from files_list so only one remains."""
     file_names: Dict[str, FileLike] = {}  # {file_name: file_path}
-    identical: List[int] = []
+    keep = bytearray(b"\x01") * len(files_list)
 
     for idx, file in enumerate(files_list):
         name = file.name
         if name in file_names:
             if file.is_identical(file_names[name]):
-                identical.append(idx)
+                keep[idx] = 0
             else:
                 return True
         else:
             file_names[name] = file
-    for idx in sorted(identical, reverse=True):
-        files_list.pop(idx)
+    files_list[:] = compress(files_list, keep)
     return False
 
 
+# Directory mtimes within this many seconds of listing are not trusted, as
+# files added in the same mtime tick don't change it. FAT has 2s resolution.
+MTIME_RESOLUTION = 2
+
+# (media dir path, media dir mtime, file names)
+_collection_names_cache: Optional[Tuple[str, int, Set[str]]] = None
+
+
+def get_collection_names(media_dir: str) -> Set[str]:
+    """Returns the names of media files in the collection media directory.
+    The result is cached until the directory's mtime changes."""
+    global _collection_names_cache
+    listed_at = time.time_ns()
+    mtime = os.stat(media_dir).st_mtime_ns
+    if _collection_names_cache is not None:
+        (cached_dir, cached_mtime, cached_names) = _collection_names_cache
+        if cached_dir == media_dir and cached_mtime == mtime:
+            return cached_names
+    root = LocalRoot(media_dir, recursive=False)
+    names = {file.name for file in root.files}
+    if listed_at - mtime > MTIME_RESOLUTION * 10**9:
+        _collection_names_cache = (media_dir, mtime, names)
+    else:
+        _collection_names_cache = None
+    return names
+
+
 def name_exists_in_collection(files_list: List[FileLike]) -> List[FileLike]:
     """Returns list of files whose names conflict with existing media files.
     And remove files if identical file exists in collection."""
-    media_dir = LocalRoot(media_paths_from_col_path(mw.col.path)[0], recursive=False)
-    collection_file_paths = media_dir.files
-    collection_files = {file.name: file for file in collection_file_paths}
-
+    media_dir = media_paths_from_col_path(mw.col.path)[0]
+    collection_names = get_collection_names(media_dir)
     name_conflicts: List[FileLike] = []
-    to_pop: List[int] = []
+    keep = bytearray(b"\x01") * len(files_list)
 
     for idx, file in enumerate(files_list):
-        if file.name in collection_files:
-            to_pop.append(idx)
-            if not file.is_identical(collection_files[file.name]):
+        if file.name in collection_names:
+            keep[idx] = 0
+            # Contents may have changed since listing, so don't reuse files.
+            collection_file = LocalFile(Path(media_dir) / file.name)
+            if not file.is_identical(collection_file):
                 name_conflicts.append(file)
 
-    for idx in sorted(to_pop, reverse=True):
-        files_list.pop(idx)
+    files_list[:] = compress(files_list, keep)
     return name_conflicts
 
 
-def add_media(file: FileLike) -> None:
+def add_media(
+    file: FileLike, data: bytes, write_data: Callable[[str, bytes], str]
+) -> None:
     """
     Tries to add media with the same basename.
     But may change the name if it overlaps with existing media.
     Therefore make sure there isn't an existing media with the same name!
     """
-    data = file.read_bytes()
-    new_name = mw.col.media.write_data(file.name, data)
+    # The backend records each added file in the media DB in its own
+    # transaction. Add-ons have no API to batch several writes into one.
+    new_name = write_data(file.name, data)
     assert new_name == file.name  # TODO: write an error dialogue?
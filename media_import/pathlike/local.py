@@ -1,10 +1,14 @@
-from hashlib import md5
-from typing import List, Union, Optional
+from hashlib import md5, sha1
+from typing import List, Tuple, Union, Optional
 from pathlib import Path
+import os
 
 from .base import RootPath, FileLike
 from .errors import RootNotFoundError, IsAFileError, MalformedURLError
 
+CHUNK_SIZE = 1024 * 1024  # Read files in chunks of 1MB when hashing
+QUICK_KEY_SIZE = 64 * 1024  # Bytes hashed for LocalFile.quick_key
+
 
 class LocalRoot(RootPath):
     raw: str
@@ -36,12 +40,16 @@ class LocalRoot(RootPath):
         return files
 
     def search_files(self, files: List["FileLike"], src: Path, recursive: bool) -> None:
-        for path in src.iterdir():
-            if path.is_file():
-                if len(path.suffix) > 1 and self.has_media_ext(path.suffix[1:]):
-                    files.append(LocalFile(path))
-            elif recursive and path.is_dir():
-                self.search_files(files, path, recursive=True)
+        # DirEntry caches its file type and stat results, unlike Path.iterdir
+        with os.scandir(src) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    path = Path(entry.path)
+                    ext = path.suffix[1:]
+                    if ext and self.has_media_ext(ext):
+                        files.append(LocalFile(path, entry))
+                elif recursive and entry.is_dir():
+                    self.search_files(files, Path(entry.path), recursive=True)
 
 
 class LocalFile(FileLike):
@@ -49,35 +57,93 @@ class LocalFile(FileLike):
     name: str
     extension: str
 
+    _entry: Optional[os.DirEntry]
     _size: Optional[int]
     _md5: Optional[str]
+    _quick_key: Optional[Tuple[int, bytes]]
+    _hashed_stat: Optional[Tuple[int, int]]  # (size, mtime) when hashes were made
     path: Path
 
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, entry: Optional[os.DirEntry] = None):
         self.key = str(path)
         self.name = path.name
         self.extension = path.suffix[1:]
         self.path = path
+        self._entry = entry
         self._size = None
         self._md5 = None
+        self._quick_key = None
+        self._hashed_stat = None
 
     @property
     def size(self) -> int:  # type: ignore
-        if not self._size:
-            self._size = self.path.stat().st_size
+        if self._size is None:
+            if self._entry is not None:
+                self._size = self._entry.stat().st_size
+            else:
+                self._size = self.path.stat().st_size
         return self._size
 
+    def _check_hashes(self) -> int:
+        """Drops cached hashes if the file changed since they were made.
+        Returns the current size, which also refreshes the cached size."""
+        stat = self.path.stat()
+        current = (stat.st_size, stat.st_mtime_ns)
+        if current != self._hashed_stat:
+            self._md5 = None
+            self._quick_key = None
+            self._hashed_stat = current
+        self._size = stat.st_size
+        return stat.st_size
+
     @property
     def md5(self) -> str:
+        self._check_hashes()
+        return self._cached_md5()
+
+    @property
+    def quick_key(self) -> Tuple[int, bytes]:
+        """(size, sha1 of the first QUICK_KEY_SIZE bytes)"""
+        self._check_hashes()
+        return self._cached_quick_key()
+
+    def _cached_md5(self) -> str:
+        """md5 as of the last _check_hashes() call."""
         if not self._md5:  # Cache result
-            self._md5 = md5(self.read_bytes()).hexdigest()
+            md5_hash = md5()
+            with self.path.open("rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    md5_hash.update(chunk)
+            self._md5 = md5_hash.hexdigest()
         return self._md5
 
+    def _cached_quick_key(self) -> Tuple[int, bytes]:
+        """quick_key as of the last _check_hashes() call."""
+        if not self._quick_key:  # Cache result
+            with self.path.open("rb") as f:
+                head = f.read(QUICK_KEY_SIZE)
+            size = self._hashed_stat[0]  # type: ignore
+            self._quick_key = (size, sha1(head).digest())
+        return self._quick_key
+
     def read_bytes(self) -> bytes:
         return self.path.read_bytes()
 
     def is_identical(self, file: FileLike) -> bool:
+        # Stat each local file once, so sizes and hashes share one snapshot.
+        size = self._check_hashes()
+        if isinstance(file, LocalFile):
+            if file._check_hashes() != size:
+                return False
+            # Avoid hashing whole files when their beginnings already differ.
+            if file._cached_quick_key() != self._cached_quick_key():
+                return False
+            if size <= QUICK_KEY_SIZE:
+                return True
+            return file._cached_md5() == self._cached_md5()
+        if file.size != size:
+            return False
         try:
-            return file.size == self.size and file.md5 == self.md5  # type: ignore
+            return file.md5 == self._cached_md5()  # type: ignore
         except AttributeError:
-            return file.size == self.size
+            return True
@@ -1,4 +1,5 @@
 from typing import Any, Dict, List, Tuple, Union, Optional
+import itertools
 import random
 import requests
 import json
@@ -34,7 +35,9 @@ ts: int - timestamp
 
 class Mega:
     def __init__(self) -> None:
-        self.sequence_num = random.randint(0, 0xFFFFFFFF)
+        # Files are downloaded from several threads. next() on a count is
+        # atomic, so no two requests get the same id.
+        self.sequence_num = itertools.count(random.randint(0, 0xFFFFFFFF))
         self.REGEXP = {
             "file": [
                 r"mega.(?:io|nz|co\.nz)/file/[0-z-_]+#[0-z-_]+",
@@ -53,10 +56,9 @@ class Mega:
                 self.URL_PATTERNS[type].append(re.compile(regexp))
 
     def api_request(self, data: Union[dict, list], root_folder: Optional[str]) -> dict:
-        params: Dict[str, Any] = {"id": self.sequence_num}
+        params: Dict[str, Any] = {"id": next(self.sequence_num)}
         if root_folder:
             params["n"] = root_folder
-        self.sequence_num += 1
 
         # ensure input data is a list
         if not isinstance(data, list):
@@ -87,7 +89,10 @@ class Mega:
     def download_file(
         self, root_folder: str, file_id: str, file_key: Tuple[int, ...]
     ) -> bytes:
-        file_data = self.api_request({"a": "g", "g": 1, "n": file_id}, root_folder)
+        try:
+            file_data = self.api_request({"a": "g", "g": 1, "n": file_id}, root_folder)
+        except MegaReqError as e:
+            raise self.to_addon_error(e)
 
         k = self.xor_key(file_key)
         iv = file_key[4:6] + (0, 0)
@@ -96,9 +101,12 @@ class Mega:
         # inaccessible also in the official also in the official web app.
         # Strangely, files can come back later.
         if "g" not in file_data:
-            raise MegaReqError("File not accessible anymore")
+            raise RequestError(msg="File not accessible anymore")
         file_url = file_data["g"]
-        encrypted_file = requests.get(file_url).content
+        response = requests.get(file_url)
+        if not response.ok:
+            raise RequestError(response.status_code, response.reason)
+        encrypted_file = response.content
 
         k_str = a32_to_str(k)
         counter = Counter.new(128, initial_value=((iv[0] << 32) + iv[1]) << 64)
@@ -112,16 +120,19 @@ class Mega:
         try:
             nodes = self.api_request(data, id)["f"]
         except MegaReqError as e:
-            if e.code in (-8, -9, -13):
-                raise RootNotFoundError(e.code)
-            elif e.code in (-1, -3):
-                raise ServerError(e.code)
-            elif e.code in (-4, -17):
-                raise RateLimitError(e.code)
-            else:
-                raise RequestError(e.code, e.message)
+            raise self.to_addon_error(e)
         return nodes
 
+    def to_addon_error(self, e: MegaReqError) -> AddonError:
+        if e.code in (-8, -9, -13):
+            return RootNotFoundError(e.code)
+        elif e.code in (-1, -3):
+            return ServerError(e.code)
+        elif e.code in (-4, -17):
+            return RateLimitError(e.code)
+        else:
+            return RequestError(e.code, e.message)
+
     def parse_url(self, url: str) -> Tuple[str, str, Optional[str]]:
         "Returns (public_handle, key, id) if valid. If not returns None. If not subfolder, id=None."
 